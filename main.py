@@ -1,14 +1,39 @@
+import queue
 import re
+import signal
+import threading
+import time
+from contextlib import contextmanager
 
 import psycopg2
 import redis
 import yaml
 import logging
-from typing import Dict, Any, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Callable, Iterator, List, Optional, Tuple, TypeVar
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar('T')
+
+# Positions of the mz_timestamp, mz_progressed, mz_state, key, and value columns in a subscription row.
+ColumnIndices = Tuple[int, int, int, int, int]
+SubscribeRow = Tuple[Any, ...]
+
+STATE_UPSERT = 'upsert'
+STATE_DELETE = 'delete'
+
+# Marks a queued delete in RedisClient's pending writes. None is not used, so that a
+# NULL upsert value still fails at flush time instead of silently deleting the key.
+_DELETE = object()
+
+_TIMESTAMP_INVALID_RE = re.compile(r"Timestamp \(\d+\) is not valid for all inputs:")
+# Type OIDs covered by psycopg2's STRING, NUMBER, and BINARY typecasters. The typecasters
+# themselves compare equal to their OIDs but are not hashable.
+_VALID_PG_TYPES = frozenset(psycopg2.STRING.values + psycopg2.NUMBER.values + psycopg2.BINARY.values)
+
 
 class Config:
     def __init__(self, config_file: str):
@@ -24,7 +49,7 @@ class Config:
     def _load_config(file_path: str) -> Dict[str, Any]:
         """Load and validate configuration from a YAML file."""
         with open(file_path, "r") as file:
-            config = yaml.safe_load(file)
+            config = yaml.load(file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
         return config
 
     class MaterializeConfig:
@@ -38,6 +63,7 @@ class Config:
             self.password = config['password']
             self.database = config['database']
             self.sql = config['sql']
+            self.fetch_size = config.get('fetch_size', 10000)
 
         @staticmethod
         def _validate_keys(config: Dict[str, Any], keys: list) -> None:
@@ -47,14 +73,20 @@ class Config:
 
     class RedisConfig:
         def __init__(self, config: Dict[str, Any]):
-            required_keys = ['host', 'port', 'db']
+            required_keys = ['db'] if 'socket' in config else ['host', 'port', 'db']
             self._validate_keys(config, required_keys)
 
-            self.host = config['host']
-            self.port = config['port']
+            self.host = config.get('host')
+            self.port = config.get('port')
+            self.socket = config.get('socket')
+            self.socket_timeout = config.get('socket_timeout')
+            self.socket_connect_timeout = config.get('socket_connect_timeout')
             self.db = config['db']
             self.mz_timestamp_key = config.get('mz_timestamp_key')
             self.key_prefix = config.get('key_prefix', '').rstrip(':')
+            self.flush_max_commands = config.get('flush_max_commands', 1000)
+            self.flush_max_interval_ms = config.get('flush_max_interval_ms', 50)
+            self.checkpoint_interval_ms = config.get('checkpoint_interval_ms', 1000)
 
         @staticmethod
         def _validate_keys(config: Dict[str, Any], keys: list) -> None:
@@ -77,53 +109,129 @@ class Config:
 
 class RedisClient:
     def __init__(self, config: Config.RedisConfig):
-        self.client = redis.StrictRedis(host=config.host, port=config.port, db=config.db, decode_responses=True)
-        self.pipeline = self.client.pipeline()
+        if config.socket is not None:
+            connection_kwargs: Dict[str, Any] = dict(unix_socket_path=config.socket)
+        else:
+            # redis-py only applies keepalive and the connect timeout to TCP connections.
+            connection_kwargs = dict(
+                host=config.host,
+                port=config.port,
+                socket_keepalive=True,
+                socket_connect_timeout=config.socket_connect_timeout
+            )
+        self.client = redis.StrictRedis(
+            db=config.db,
+            socket_timeout=config.socket_timeout,
+            decode_responses=False,
+            **connection_kwargs
+        )
+        self.pipeline = self.client.pipeline(transaction=False)
         self.mz_timestamp_key = config.mz_timestamp_key
-        self.key_prefix = config.key_prefix
+        self._prefix_bytes = f"{config.key_prefix}:".encode() if config.key_prefix else b''
+        self.flush_max_commands = config.flush_max_commands
+        self.flush_max_interval = config.flush_max_interval_ms / 1000
+        # Final write per Redis key since the last flush; _DELETE marks a delete.
+        self._pending: Dict[bytes, Any] = {}
+        self._first_enqueue_monotonic = 0.0
+        self.checkpoint_interval = config.checkpoint_interval_ms / 1000
+        self._pending_timestamp: Optional[int] = None
+        self._latest_timestamp: Optional[int] = None
+        self._last_checkpoint_ts: Optional[int] = None
+        self._last_checkpoint_time = 0.0
 
     def get_latest_timestamp(self) -> Optional[int]:
         """Fetch the latest mz_timestamp from Redis."""
         if self.mz_timestamp_key is not None:
             timestamp = self.client.get(self.mz_timestamp_key)
-            logger.debug(f"Fetched latest mz_timestamp from Redis: {timestamp}")
-            return timestamp
+            logger.debug("Fetched latest mz_timestamp from Redis: %s", timestamp)
+            return int(timestamp) if timestamp is not None else None
         return None
 
-    def set_latest_timestamp(self, mz_timestamp: int) -> None:
-        """Store the latest mz_timestamp in Redis."""
-        if self.mz_timestamp_key is not None:
-            self.pipeline.set(self.mz_timestamp_key, mz_timestamp)
+    def maybe_checkpoint(self, mz_timestamp: int) -> None:
+        """Record the latest mz_timestamp, storing it on the next flush at most once per checkpoint interval."""
+        if self.mz_timestamp_key is None:
+            return
+        self._latest_timestamp = mz_timestamp
+        now = time.monotonic()
+        if mz_timestamp == self._last_checkpoint_ts or now - self._last_checkpoint_time < self.checkpoint_interval:
+            return
+        self._pending_timestamp = mz_timestamp
+        self._last_checkpoint_ts = mz_timestamp
+        self._last_checkpoint_time = now
+
+    def flush(self) -> None:
+        """Send all queued writes to Redis in a single round trip.
+
+        Sets are batched into one MSET and deletes into one DEL. The mz_timestamp
+        is queued after the data so that a crash mid-flush never persists a
+        checkpoint ahead of the writes it covers.
+        """
+        if self._pending:
+            sets = {key: value for key, value in self._pending.items() if value is not _DELETE}
+            deletes = [key for key, value in self._pending.items() if value is _DELETE]
+            if sets:
+                self.pipeline.mset(sets)
+            if deletes:
+                self.pipeline.delete(*deletes)
+        if self._pending_timestamp is not None:
+            self.pipeline.set(self.mz_timestamp_key, self._pending_timestamp)
         self.pipeline.execute()
-        self.pipeline = self.client.pipeline()
-        logger.info(f"Updated mz_timestamp in Redis: {mz_timestamp}")
-
-    def format_key(self, key: str) -> str:
+        if self._pending_timestamp is not None:
+            logger.debug("Updated mz_timestamp in Redis: %s", self._pending_timestamp)
+        self._pending = {}
+        self._pending_timestamp = None
+
+    def close(self) -> None:
+        """Flush all queued writes along with the latest mz_timestamp seen and disconnect from Redis."""
+        if self._latest_timestamp is not None:
+            self._pending_timestamp = self._latest_timestamp
+        self.flush()
+        self.client.close()
+
+    def maybe_flush(self) -> None:
+        """Flush if the oldest queued write has waited longer than the flush interval."""
+        if self._pending and time.monotonic() - self._first_enqueue_monotonic >= self.flush_max_interval:
+            self.flush()
+
+    def _enqueue(self, redis_key: bytes, value: Any) -> None:
+        """Queue a write, replacing any earlier write to the same key, and flush once the key limit is reached."""
+        if not self._pending:
+            self._first_enqueue_monotonic = time.monotonic()
+        self._pending[redis_key] = value
+        if len(self._pending) >= self.flush_max_commands:
+            self.flush()
+
+    def format_key(self, key: Any) -> bytes:
         """Format the Redis key with the configured prefix."""
-        return f"{self.key_prefix}:{key}" if self.key_prefix else key
+        if isinstance(key, str):
+            return self._prefix_bytes + key.encode()
+        if isinstance(key, (bytes, memoryview)):
+            return self._prefix_bytes + bytes(key)
+        return self._prefix_bytes + str(key).encode()
 
-    def set_cache(self, key: str, value: str) -> None:
+    def set_cache(self, key: Any, value: Any) -> None:
         """Set a key-value pair in Redis."""
         redis_key = self.format_key(key)
-        self.pipeline.set(redis_key, value)
-        logger.debug(f"Set Redis key: {redis_key} = {value}")
+        self._enqueue(redis_key, value)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Set Redis key: %s = %s", redis_key, value)
 
-    def delete_cache(self, key: str) -> None:
+    def delete_cache(self, key: Any) -> None:
         """Delete a key from Redis."""
         redis_key = self.format_key(key)
-        self.pipeline.delete(redis_key)
-        logger.debug(f"Deleted Redis key: {redis_key}")
+        self._enqueue(redis_key, _DELETE)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Deleted Redis key: %s", redis_key)
 
 
-def connect_to_materialize(config: Config.MaterializeConfig) -> psycopg2.extensions.connection:
-    """Establish a connection to the Materialize database."""
-    conn = psycopg2.connect(
+def materialize_connection_params(config: Config.MaterializeConfig) -> Dict[str, Any]:
+    """Build the psycopg2 connection parameters for the Materialize database."""
+    return dict(
         host=config.host,
         port=config.port,
         user=config.user,
         password=config.password,
         dbname=config.database,
-        cursor_factory=RealDictCursor,
         application_name="mz-redis-sync",
         # psycopg2 does not make it easy to redirect the welcome
         # notice to our logger. So instead, we disable it and manually
@@ -131,16 +239,154 @@ def connect_to_materialize(config: Config.MaterializeConfig) -> psycopg2.extensi
         options="--welcome_message=off"
     )
 
+
+def connect_to_materialize(config: Config.MaterializeConfig) -> psycopg2.extensions.connection:
+    """Establish a connection to the Materialize database."""
+    conn = psycopg2.connect(**materialize_connection_params(config))
     conn.autocommit = True
     return conn
 
 
+def run_with_pooled_connection(pool: ThreadedConnectionPool, fn: Callable[..., T], *args: Any) -> T:
+    """Run fn with a connection borrowed from the pool, returning the connection afterwards."""
+    conn = pool.getconn()
+    try:
+        conn.autocommit = True
+        return fn(conn, *args)
+    finally:
+        pool.putconn(conn)
+
+
+def log_materialize_metadata(conn: psycopg2.extensions.connection) -> None:
+    """Log the Materialize environment, role, database, schema, and cluster in use."""
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("SELECT mz_environment_id(), current_database(), current_schema(), current_role()")
+        metadata = cur.fetchone()
+        cur.execute("SHOW CLUSTER")
+        cluster = cur.fetchone()
+        logger.info(
+            f"Connected to Materialize Environment {metadata['mz_environment_id']} "
+            f"using role {metadata['current_role']}")
+        logger.info(
+            f"Using Materialize database {metadata['current_database']} "
+            f"and schema {metadata['current_schema']} on cluster {cluster['cluster']}")
+
+
 def build_subscribe_statement(sql: str, ts: Optional[int]) -> str:
     """Create a SQL SUBSCRIBE statement with an optional timestamp."""
     if ts:
-        return f"DECLARE c CURSOR FOR SUBSCRIBE ({sql}) WITH (PROGRESS) AS OF {ts} ENVELOPE UPSERT (KEY (key))"
+        return f"SUBSCRIBE ({sql}) WITH (PROGRESS) AS OF {ts} ENVELOPE UPSERT (KEY (key))"
     else:
-        return f"DECLARE c CURSOR FOR SUBSCRIBE ({sql}) WITH (SNAPSHOT, PROGRESS) ENVELOPE UPSERT (KEY (key))"
+        return f"SUBSCRIBE ({sql}) WITH (SNAPSHOT, PROGRESS) ENVELOPE UPSERT (KEY (key))"
+
+
+def subscribe_column_indices(description) -> ColumnIndices:
+    """Resolve the positions of the mz_timestamp, mz_progressed, mz_state, key, and value columns."""
+    colnames = [desc.name for desc in description]
+    return (
+        colnames.index('mz_timestamp'),
+        colnames.index('mz_progressed'),
+        colnames.index('mz_state'),
+        colnames.index('key'),
+        colnames.index('value'),
+    )
+
+
+@contextmanager
+def fetch_batches(
+        cur: psycopg2.extensions.cursor,
+        fetch_size: int) -> Iterator[Iterator[Tuple[ColumnIndices, List[SubscribeRow]]]]:
+    """Provide an iterator over the column indices and rows of each fetch from the subscription cursor.
+
+    Fetches run on a background thread, so the next batch is read from Materialize
+    while the caller is still processing the current one. psycopg2 releases the GIL
+    while waiting on the network. On exit, any in-flight fetch is cancelled and the
+    thread is joined, so the cursor can be safely closed afterwards.
+    """
+    batches: queue.Queue = queue.Queue(maxsize=1)
+    stop = threading.Event()
+
+    def hand_off(item: Any) -> None:
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def fetch() -> None:
+        try:
+            columns: Optional[ColumnIndices] = None
+            while not stop.is_set():
+                rows = cur.fetchmany(fetch_size)
+                if columns is None:
+                    columns = subscribe_column_indices(cur.description)
+                hand_off((columns, rows))
+        except Exception as e:
+            # After a stop, this is the cancelled fetch and nobody is waiting for it.
+            hand_off(e)
+
+    def consume() -> Iterator[Tuple[ColumnIndices, List[SubscribeRow]]]:
+        while True:
+            batch = batches.get()
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+
+    fetcher = threading.Thread(target=fetch, name="mz-redis-sync-fetch", daemon=True)
+    fetcher.start()
+    try:
+        yield consume()
+    finally:
+        stop.set()
+        if fetcher.is_alive():
+            # Interrupt a FETCH that is waiting on Materialize. The cancelled
+            # transaction is aborted, so psycopg2 skips CLOSE for the cursor.
+            cur.connection.cancel()
+        fetcher.join()
+
+
+def process_batch(redis_client: RedisClient, columns: ColumnIndices, rows: List[SubscribeRow]) -> None:
+    """Queue the Redis writes and checkpoint for one batch of subscription rows."""
+    ts_idx, progressed_idx, state_idx, key_idx, value_idx = columns
+    # Bind methods once per batch rather than looking them up on every row.
+    maybe_checkpoint = redis_client.maybe_checkpoint
+    set_cache = redis_client.set_cache
+    delete_cache = redis_client.delete_cache
+
+    for row in rows:
+        if row[progressed_idx]:
+            # mz_timestamp is a numeric column, which psycopg2 decodes as a Decimal.
+            maybe_checkpoint(int(row[ts_idx]))
+            continue
+        state = row[state_idx]
+        if state == STATE_UPSERT:
+            set_cache(row[key_idx], row[value_idx])
+        elif state == STATE_DELETE:
+            delete_cache(row[key_idx])
+        else:
+            raise ValueError(f"Unknown subscribe state {state}")
+
+
+def install_stop_handlers() -> threading.Event:
+    """Handle SIGINT and SIGTERM by requesting a graceful stop, then fall back to the OS default.
+
+    The main loop stops between batches so that the final flush can checkpoint everything
+    written so far. A second signal kills the process without running any Python cleanup,
+    so it works even if Materialize has stalled and the fetch thread cannot be joined.
+    """
+    stop = threading.Event()
+
+    def request_stop(signum, frame) -> None:
+        stop.set()
+        # SIG_DFL rather than default_int_handler: a KeyboardInterrupt would unwind through
+        # fetch_batches and wait there on a fetch thread that may never return.
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, request_stop)
+    return stop
 
 
 def validate_sql_columns(conn: psycopg2.extensions.connection, sql_query: str) -> None:
@@ -171,7 +417,7 @@ def validate_sql_columns(conn: psycopg2.extensions.connection, sql_query: str) -
 
             type_errors = []
             for colname, coltype in zip(colnames, coltypes):
-                if coltype not in [psycopg2.STRING, psycopg2.NUMBER, psycopg2.BINARY]:
+                if coltype not in _VALID_PG_TYPES:
                     type_errors.append(f"'{colname}' has an invalid type: {coltype}")
 
             if type_errors:
@@ -196,51 +442,63 @@ def main():
     redis_client = RedisClient(config.redis)
     logger.info("Connected to Redis.")
 
-    mz_conn = connect_to_materialize(config.materialize)
-    with mz_conn.cursor() as cur:
-        cur.execute("SELECT mz_environment_id(), current_database(), current_schema(), current_role()")
-        metadata = cur.fetchone()
-        cur.execute("SHOW CLUSTER")
-        cluster = cur.fetchone()
-        logger.info(
-            f"Connected to Materialize Environment {metadata['mz_environment_id']} "
-            f"using role {metadata['current_role']}")
-        logger.info(
-            f"Using Materialize database {metadata['current_database']} "
-            f"and schema {metadata['current_schema']} on cluster {cluster['cluster']}")
+    # Introspection and query validation run on short-lived pooled connections,
+    # concurrently with opening the dedicated SUBSCRIBE connection.
+    metadata_pool = ThreadedConnectionPool(minconn=0, maxconn=2, **materialize_connection_params(config.materialize))
+    try:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            metadata = executor.submit(run_with_pooled_connection, metadata_pool, log_materialize_metadata)
+            validation = executor.submit(
+                run_with_pooled_connection, metadata_pool, validate_sql_columns, config.materialize.sql)
+
+            mz_conn = connect_to_materialize(config.materialize)
+            starting_timestamp = redis_client.get_latest_timestamp()
 
-    validate_sql_columns(mz_conn, config.materialize.sql)
+            metadata.result()
+            validation.result()
+    finally:
+        metadata_pool.closeall()
 
-    starting_timestamp = redis_client.get_latest_timestamp()
     logger.info(f"Latest mz_timestamp from Redis: {starting_timestamp}")
 
     subscribe = build_subscribe_statement(config.materialize.sql, starting_timestamp)
     logger.info(subscribe)
 
-    with mz_conn.cursor() as cur:
-        cur.execute("BEGIN")
+    stop = install_stop_handlers()
+
+    # The subscription is consumed through a cursor rather than COPY (SUBSCRIBE ...) TO STDOUT.
+    # psycopg2 hands COPY output to Python one row at a time as escaped text, so COPY would not
+    # reduce per-row work, and FETCH boundaries are what drive the Redis flush policy.
+    # psycopg2 only allows named (server-side) cursors inside a transaction, and
+    # opens one automatically once autocommit is off.
+    mz_conn.autocommit = False
+    with mz_conn.cursor(name='c') as cur:
         cur.execute(subscribe)
 
-        while True:
-            try:
-                cur.execute("FETCH 100 c")
-                for row in cur:
-                    mz_timestamp = int(row['mz_timestamp'])
-                    if bool(row['mz_progressed']):
-                        redis_client.set_latest_timestamp(mz_timestamp)
-                    elif row['mz_state'] == 'upsert':
-                        redis_client.set_cache(row['key'], row['value'])
-                    elif row['mz_state'] == 'delete':
-                        redis_client.delete_cache(row['key'])
+        fetch_size = config.materialize.fetch_size
+        try:
+            with fetch_batches(cur, fetch_size) as batches:
+                for columns, rows in batches:
+                    process_batch(redis_client, columns, rows)
+                    if stop.is_set():
+                        break
+
+                    if len(rows) < fetch_size:
+                        # The subscription is caught up, so the next FETCH blocks until
+                        # Materialize has new data. Don't hold writes back while waiting.
+                        redis_client.flush()
                     else:
-                        raise ValueError(f"Unknown subscribe state {row['mz_state']}")
-            except psycopg2.errors.InternalError_ as e:
-                pattern = r"Timestamp \(\d+\) is not valid for all inputs:"
-                if re.search(pattern, str(e)):
-                    raise RuntimeError("mz-redis-sync has been offline for to long :(")
-            except Exception as e:
-                logger.error(f"Error processing rows: {e}")
-                raise
+                        redis_client.maybe_flush()
+        except psycopg2.errors.InternalError_ as e:
+            if _TIMESTAMP_INVALID_RE.search(str(e)):
+                raise RuntimeError("mz-redis-sync has been offline for to long :(")
+            raise
+        except Exception as e:
+            logger.error(f"Error processing rows: {e}")
+            raise
+
+    logger.info("Shutting down, flushing pending writes to Redis.")
+    redis_client.close()
 
 
 if __name__ == '__main__':